@@ -0,0 +1,409 @@
+import os
+import sys
+import gc
+import copy
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import contextlib
+from unittest import mock
+from datetime import datetime, timezone
+from singer import metadata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tap_simpro import load_schemas, populate_metadata
+from tap_simpro import handlers, output
+from tap_simpro.config import (
+    flatten_specs,
+    crawl_trees,
+    _vendor_order_item_allocations,
+)
+from tap_simpro.fetch import prepare_record
+from tap_simpro.flatten import compile_flattener
+from tap_simpro.transforms import transform_catalogs
+
+
+# CPU cost per record of the record-processing hot paths, over synthetic rows shaped like Simpro's responses
+# No network or event loop time is included; handlers that fetch are fed rows directly
+# Timings depend on the machine, so baselines aren't committed
+#   python benchmarks/bench_records.py --save    record a baseline on this machine
+#   python benchmarks/bench_records.py           compare against it, exiting 1 on a regression
+default_baseline = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+# a case regresses when its best time per record is this much slower than the baseline's
+default_threshold = 0.25
+# fast cases get more rows so each timed run is at least this long, as shorter ones are mostly timer and scheduler noise
+min_run_seconds = 0.01
+# cases faster than this per record swing the most between runs even so, and are allowed twice the slowdown
+fast_case_us = 2
+
+schemas = load_schemas()
+extraction_time = datetime.now(timezone.utc).astimezone()
+rng = random.Random(0)
+
+
+# a value for each field of a JSON schema, like the API returns before the tap touches it
+def fake(schema, name="", i=0):
+    types = schema.get("type", ["string"])
+    types = [types] if isinstance(types, str) else types
+    kind = next((t for t in types if t != "null"), "string")
+
+    if kind == "object":
+        return {k: fake(v, k, i) for k, v in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fake(schema.get("items", {}), name, j) for j in range(3)]
+    if kind == "integer":
+        return rng.randint(1, 100000)
+    if kind == "number":
+        return round(rng.uniform(0, 10000), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if schema.get("format") == "date-time":
+        return f"2024-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}T{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:00+10:00"
+    if schema.get("format") == "date":
+        return f"2024-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+    if name == "ID" or name.endswith("ID"):
+        return str(rng.randint(1, 100000))
+    return f"{name} {i} " + "x" * rng.randint(0, 40)
+
+
+def fake_rows(resource, n):
+    return [fake(schemas[resource], i=i) for i in range(n)]
+
+
+def fake_custom_fields(resource, n):
+    custom_fields = list(
+        schemas[resource]["properties"]["CustomFields"]["properties"].keys()
+    )
+    rows = fake_rows(resource, n)
+    for row in rows:
+        # CustomFields come back as a list, which transform_record maps by name
+        row["CustomFields"] = [
+            {"CustomField": {"ID": j, "Name": name}, "Value": f"value {j}"}
+            for j, name in enumerate(custom_fields)
+        ]
+    return rows
+
+
+def fake_job_details(n):
+    rows = fake_rows("jobs", n)
+    for row in rows:
+        row["Sections"] = [
+            {
+                **fake(schemas["job_sections"], i=s),
+                "CostCenters": fake_rows("job_cost_centers", 4),
+            }
+            for s in range(3)
+        ]
+    return rows
+
+
+def fake_quote_details(n):
+    rows = fake_rows("quotes", n)
+    for row in rows:
+        row["Sections"] = [
+            {
+                **fake(schemas["quote_sections"], i=s),
+                "CostCenters": fake_rows("quote_cost_centers", 4),
+            }
+            for s in range(3)
+        ]
+    return rows
+
+
+def fake_catalogs(n):
+    rows = fake_rows("catalogs", n)
+    for i, row in enumerate(rows):
+        row["Name"] = (
+            f"Supplier {i} non catalog item - Invoice INV{i:06}"
+            if i % 2
+            else f"Copper pipe {i}mm"
+        )
+    return rows
+
+
+def fake_timesheets(n):
+    timesheets = []
+    for i in range(n):
+        t = fake(schemas["employee_timesheets"], i=i)
+        if i % 4:
+            t["ScheduleType"] = "Job"
+            t["_href"] = f"/api/v1.0/companies/0/jobs/{1000 + i}/sections/{i % 7}/costCenters/{2000 + i}/schedules/{3000 + i}"
+        else:
+            t["ScheduleType"] = "Activity"
+            t["_href"] = f"/api/v1.0/companies/0/activitySchedules/{4000 + i}"
+        timesheets.append(t)
+    return timesheets
+
+
+def fake_receipts(n):
+    rows = fake_rows("vendor_order_receipts", n)
+    for row in rows:
+        row["VendorOrderNo"] = str(rng.randint(1, 100000))
+        row["Catalogs"] = [
+            {
+                "Catalog": {"ID": rng.randint(1, 100000), "Name": f"Catalog {c}"},
+                "Allocations": [
+                    {
+                        "Quantity": rng.randint(1, 20),
+                        "Job": {"ID": rng.randint(1, 100000)},
+                    }
+                    for _ in range(2)
+                ],
+            }
+            for c in range(4)
+        ]
+    return rows
+
+
+def fake_vendor_order_catalogs(n):
+    return [
+        {
+            "Catalog": {"ID": rng.randint(1, 100000), "Name": f"Catalog {i}"},
+            "Price": round(rng.uniform(0, 500), 2),
+            "Allocations": [
+                {
+                    "Quantity": rng.randint(1, 20),
+                    "Job": {"ID": rng.randint(1, 100000)},
+                }
+                for _ in range(3)
+            ],
+        }
+        for i in range(n)
+    ]
+
+
+def write(resource):
+    schema = schemas[resource]
+    mdata = metadata.to_list(populate_metadata(schema))
+    return lambda rows: output.write_records(
+        rows, resource, schema, mdata, extraction_time
+    )
+
+
+def prepare(resource):
+    schema = schemas[resource]
+    return lambda rows: [prepare_record(row, resource, schema) for row in rows]
+
+
+def flattener(resource):
+    flatten = compile_flattener(flatten_specs[resource])
+    return lambda rows: [r for row in rows for r in flatten(row)]
+
+
+def timesheets(rows):
+    async def get_basic(session, resource, url):
+        return rows
+
+    # only the href parsing, writing is timed by its own case
+    with mock.patch.object(handlers, "get_basic", get_basic), mock.patch.object(
+        handlers, "write_many", lambda *args: None
+    ):
+        asyncio.get_event_loop().run_until_complete(
+            handlers.handle_timesheets(
+                None,
+                "employee_timesheets",
+                1,
+                "employees/1/timesheets/?Includes=Job,Activity",
+                schemas["employee_timesheets"],
+                {},
+                [],
+                extraction_time,
+            )
+        )
+
+
+def receipt_items(rows):
+    annotate = crawl_trees["vendor_order_receipts"][0]["annotate"]
+    flatten = crawl_trees["vendor_order_receipts"][0]["children"][0]["rows"]
+    items = []
+    for row in rows:
+        annotate(None, row)
+        items.extend(flatten(row))
+    return items
+
+
+def item_allocations(rows):
+    vendor_order = {"ID": "123", "AssignedTo": {"ID": 45}}
+    return [
+        a for row in rows for a in _vendor_order_item_allocations(vendor_order, row)
+    ]
+
+
+# name -> (function over a list of rows, rows generator, records produced per input row)
+cases = {
+    "transform_record jobs": (
+        prepare("jobs"),
+        lambda n: fake_custom_fields("jobs", n),
+        1,
+    ),
+    "transform_record employees": (
+        prepare("employees"),
+        lambda n: fake_custom_fields("employees", n),
+        1,
+    ),
+    "transform_record quotes": (
+        prepare("quotes"),
+        lambda n: fake_rows("quotes", n),
+        1,
+    ),
+    "write_record jobs": (
+        write("jobs"),
+        lambda n: prepare("jobs")(fake_custom_fields("jobs", n)),
+        1,
+    ),
+    "write_record employee_timesheets": (
+        write("employee_timesheets"),
+        fake_timesheets,
+        1,
+    ),
+    "transform_catalogs": (
+        lambda rows: [transform_catalogs(row) for row in rows],
+        fake_catalogs,
+        1,
+    ),
+    "flatten job_sections": (flattener("job_sections"), fake_job_details, 3),
+    "flatten job_cost_centers": (
+        lambda rows: flattener("job_cost_centers")(flattener("job_sections")(rows)),
+        fake_job_details,
+        12,
+    ),
+    "flatten quote_cost_centers": (
+        flattener("quote_cost_centers"),
+        fake_quote_details,
+        12,
+    ),
+    "handle_timesheets href parsing": (timesheets, fake_timesheets, 1),
+    "vendor_order_receipt_items": (receipt_items, fake_receipts, 8),
+    "vendor_order_item_allocations": (
+        item_allocations,
+        fake_vendor_order_catalogs,
+        3,
+    ),
+}
+
+
+# best and median microseconds per record produced over `repeat` runs, and the rows each run had
+# with `calibrate`, `n` is raised for fast cases; comparisons pass the baseline's so both time the same rows
+def run_case(fn, make_rows, per_row, n, repeat, calibrate=True):
+    # the same rows every time, whichever cases ran before
+    rng.seed(0)
+    rows = make_rows(n)
+    times = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # collections triggered by earlier cases' garbage would land on whichever run they happen in
+        gc.collect()
+        gc.disable()
+        try:
+            fn(copy.deepcopy(rows))
+            warm = copy.deepcopy(rows)
+            start = time.perf_counter()
+            fn(warm)
+            seconds = time.perf_counter() - start
+            if calibrate and seconds < min_run_seconds:
+                n = int(n * min_run_seconds / max(seconds, 1e-6)) + 1
+                rng.seed(0)
+                rows = make_rows(n)
+                fn(copy.deepcopy(rows))
+
+            # each run gets its own copy, as most of these paths change the rows in place
+            inputs = [copy.deepcopy(rows) for _ in range(repeat)]
+            for rows in inputs:
+                start = time.perf_counter()
+                fn(rows)
+                times.append((time.perf_counter() - start) * 1e6 / (n * per_row))
+        finally:
+            gc.enable()
+    return min(times), statistics.median(times), n
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the record-processing hot paths per record"
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the baseline"
+    )
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument(
+        "--threshold", type=float, help="allowed slowdown, e.g. 0.25 for 25%%"
+    )
+    parser.add_argument("--records", type=int, default=1000, help="input rows per run")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "cases", nargs="*", help="only run cases containing these names"
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    elif not args.save:
+        print(f"No baseline at {args.baseline} to compare with, run with --save first")
+    threshold = args.threshold or baseline.get("threshold", default_threshold)
+
+    results = {}
+    regressions = []
+    print(
+        f'{"case":<36}{"best us/rec":>12}{"median":>10}{"baseline":>10}{"change":>9}'
+    )
+    for name, (fn, make_rows, per_row) in cases.items():
+        if args.cases and not any(c in name for c in args.cases):
+            continue
+
+        base = baseline.get("cases", {}).get(name)
+        n = base["records"] if base else args.records
+        best, median, n = run_case(
+            fn, make_rows, per_row, n, args.repeat, calibrate=not base
+        )
+        allowed = threshold
+        if base and base["best_us_per_record"] < fast_case_us:
+            allowed = threshold * 2
+        # a noisy neighbour can slow a whole case down, so a regression has to show up again to count
+        for _ in range(2):
+            if not base or best / base["best_us_per_record"] - 1 <= allowed:
+                break
+            retry = run_case(fn, make_rows, per_row, n, args.repeat, calibrate=False)
+            best, median = min((best, median), retry[:2])
+        results[name] = {
+            "best_us_per_record": round(best, 3),
+            "median_us_per_record": round(median, 3),
+            "records": n,
+        }
+
+        line = f"{name:<36}{best:>12.3f}{median:>10.3f}"
+        if base:
+            change = best / base["best_us_per_record"] - 1
+            line += f'{base["best_us_per_record"]:>10.3f}{change:>+9.0%}'
+            if change > allowed:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump(
+                {
+                    "threshold": threshold,
+                    "python": sys.version.split()[0],
+                    "cases": results,
+                },
+                file,
+                indent=2,
+            )
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print(
+            f"{len(regressions)} case(s) over {threshold:.0%} slower than the baseline"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
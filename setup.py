@@ -16,11 +16,15 @@ setup(
             "pylint",
             "ipdb",
             "nose",
-        ]
+            "pyflakes",
+        ],
+        "zstd": ["zstandard"],
     },
     entry_points="""
           [console_scripts]
           tap-simpro=tap_simpro:main
+          tap-simpro-daemon=tap_simpro.daemon:main
+          tap-simpro-webhooks=tap_simpro.webhooks:main
       """,
     packages=["tap_simpro"],
     package_data={"tap_simpro": ["tap_simpro/schemas/*.json"]},
@@ -1,25 +1,58 @@
 import os
+import sys
 import json
 import asyncio
+import contextlib
 import aiohttp
+from datetime import datetime, timezone, timedelta
 import singer
 from singer import metadata
+from singer.bookmarks import get_bookmark
 
 from tap_simpro.utility import (
     await_futures,
     get_abs_path,
     streams,
     sub_streams,
-    format_date,
     set_base_url,
+    set_cassette,
     RateLimiter,
 )
-from tap_simpro.fetch import handle_resource
+from tap_simpro.cassette import Cassette
+from tap_simpro.fetch import handle_resource, handle_ids, set_bookmark_lookback
+from tap_simpro import output, utility
+from tap_simpro.paging import load_page_sizes, save_page_sizes, freeze_page_sizes
+from tap_simpro.hedging import set_hedging
+from tap_simpro.daemon import Daemon
+from tap_simpro.webhooks import ChangeQueue, start_receiver
+from tap_simpro import budget
+from tap_simpro.config import webhook_streams
+from tap_simpro import profiling
 
 logger = singer.get_logger()
 
 REQUIRED_CONFIG_KEYS = ["access_token", "company_id", "base_url"]
 
+# exit non-zero after writing state if "any" stream failed (default), only if "all" of them failed, or "never"
+failure_policies = ["any", "all", "never"]
+failure_policy = "any"
+
+# with a webhook queue set, only notified rows are synced until a full poll is due again as a consistency backstop
+change_queue = None
+webhook_poll_hours = 24
+# the only streams notifications can be queued for
+webhook_stream_ids = set(stream for stream, _ in webhook_streams.values())
+
+# with --profile, where to write the folded stacks; "" to put them next to the output
+profile_path = None
+
+
+class StreamSyncError(Exception):
+    def __init__(self, message, state):
+        super().__init__(message)
+        # the state that was written, for anything running more syncs in the same process
+        self.state = state
+
 
 def load_schemas():
     schemas = {}
@@ -104,8 +137,19 @@ def get_stream_from_catalog(stream_id, catalog):
 
 async def do_sync(session, state, catalog):
     selected_stream_ids = get_selected_streams(catalog)
+    output.start()
+    budget.start_run()
+
+    started = datetime.now(timezone.utc)
+    changes = None
+    if change_queue:
+        last_poll = change_queue.get_last_poll()
+        if last_poll and started - last_poll < timedelta(hours=webhook_poll_hours):
+            changes = change_queue.pending()
 
     stream_futures = []
+    # streams the API budget stopped last time get first go at it, finishing before the others start
+    unfinished_futures = []
 
     for stream in catalog["streams"]:
         stream_id = stream["tap_stream_id"]
@@ -116,43 +160,236 @@ async def do_sync(session, state, catalog):
 
         # if stream is selected, write schema and sync
         if stream_id in selected_stream_ids and stream_id not in sub_streams:
-            singer.write_schema(stream_id, stream_schema, stream["key_properties"])
+            output.write_schema(stream_id, stream_schema, stream["key_properties"])
 
             for substream_id in streams.get(stream_id, []):
                 if substream_id in selected_stream_ids:
                     substream = get_stream_from_catalog(substream_id, catalog)
                     schemas[substream_id] = substream["schema"]
-                    singer.write_schema(
+                    output.write_schema(
                         substream_id, substream["schema"], substream["key_properties"]
                     )
 
-            stream_futures.append(
-                handle_resource(session, stream_id, schemas, state, mdata)
+            # streams Simpro doesn't send webhooks for keep polling as usual
+            stream_changes = (
+                changes.get(stream_id, [])
+                if changes is not None and stream_id in webhook_stream_ids
+                else None
+            )
+            future = sync_stream(
+                session, stream_id, schemas, state, mdata, stream_changes
             )
+            if stream_id in budget.previously_unfinished:
+                unfinished_futures.append(future)
+            else:
+                stream_futures.append(future)
+
+    results = await await_futures(unfinished_futures)
+    results += await await_futures(stream_futures)
+    # all records have to be out before the state that covers them
+    failed_output = await output.finish()
+    results = [
+        (stream_id, fail_output(stream_id, bookmarks, failed_output))
+        for stream_id, bookmarks in results
+    ]
+
+    new_state = {}
+    failed = []
+    for stream_id, bookmarks in results:
+        if bookmarks is None:
+            failed.append(stream_id)
+            bookmarks = get_previous_bookmarks(stream_id, state)
+        new_state.update(bookmarks)
+    singer.write_state(new_state)
+    budget.save_ledger()
+
+    # only drop notifications once the rows they cover are out, which they aren't for streams the API budget stopped
+    if change_queue:
+        for stream_id, bookmarks in results:
+            if bookmarks is None or stream_id in budget.unfinished:
+                continue
+            if changes is None:
+                change_queue.remove_before(stream_id, started.isoformat())
+            else:
+                change_queue.remove(stream_id, changes.get(stream_id, []))
+        if changes is None and not failed and not budget.unfinished:
+            change_queue.set_last_poll(started)
+
+    if failed and (
+        failure_policy == "any"
+        or (failure_policy == "all" and len(failed) == len(results))
+    ):
+        raise StreamSyncError(f"Streams failed: {', '.join(failed)}", new_state)
+
+    return new_state
+
+
+# each stream is its own failure domain so one failing doesn't cancel the others or lose their bookmarks
+async def sync_stream(session, stream_id, schemas, state, mdata, changes=None):
+    profiling.label(
+        stream=stream_id, handler="handle_resource" if changes is None else "handle_ids"
+    )
+    try:
+        if changes is None:
+            return stream_id, await handle_resource(
+                session, stream_id, schemas, state, mdata
+            )
+
+        await handle_ids(
+            session, stream_id, [id for id, _ in changes], schemas, state, mdata
+        )
+        # bookmarks only move on with a full poll
+        return stream_id, get_previous_bookmarks(stream_id, state)
+    # not a failure: checkpoint at the previous bookmarks so the next run picks the stream up again
+    except budget.BudgetExhausted as e:
+        logger.warning(f"{stream_id} stopped, {e}")
+        budget.unfinished.add(stream_id)
+        return stream_id, get_previous_bookmarks(stream_id, state)
+    except Exception as e:
+        logger.exception(f"{stream_id} failed, keeping its previous bookmarks: {e}")
+        return stream_id, None
+
+
+# a stream whose records, or a sub-stream's, failed to be written keeps its previous bookmarks
+def fail_output(stream_id, bookmarks, failed_output):
+    own = {stream_id, *streams.get(stream_id, [])}
+    if bookmarks is not None and failed_output & own:
+        logger.error(f"{stream_id} failed, keeping its previous bookmarks")
+        return None
+    return bookmarks
+
+
+def get_previous_bookmarks(stream_id, state):
+    bookmarks = {}
+    for s in [stream_id, *streams.get(stream_id, [])]:
+        bookmark = get_bookmark(state, s, "since")
+        if bookmark:
+            bookmarks[s] = bookmark
+    return bookmarks
+
+
+def configure(config):
+    global failure_policy, change_queue, webhook_poll_hours
+    set_base_url(config.get("base_url"))
+
+    if config.get("failure_policy"):
+        if config["failure_policy"] not in failure_policies:
+            raise ValueError(
+                f"Unknown failure_policy {config['failure_policy']}, expected one of {failure_policies}"
+            )
+        failure_policy = config["failure_policy"]
+
+    # optionally transform and serialise records on a "thread" or "process" pool rather than the event loop
+    if config.get("record_workers"):
+        output.set_record_pool(
+            config.get("record_pool", "thread"),
+            int(config["record_workers"]),
+            config.get("record_queue_size"),
+        )
 
-    bookmarks_dicts = await await_futures(stream_futures)
-    state = {k: format_date(v) for dict in bookmarks_dicts for k, v in dict.items()}
-    singer.write_state(state)
+    if "bookmark_lookback_minutes" in config:
+        set_bookmark_lookback(float(config["bookmark_lookback_minutes"]))
 
+    # page sizes tuned from each endpoint's response times and sizes are remembered in this file
+    if config.get("page_size_cache"):
+        load_page_sizes(config["page_size_cache"])
 
-async def run_async(config, state, catalog):
+    # duplicate detail calls that are slower than usual and take whichever returns first
+    if config.get("hedge_requests"):
+        set_hedging(config.get("hedge_percentile"), config.get("hedge_budget"))
+
+    # write each stream to its own compressed NDJSON file plus a manifest, leaving only STATE on stdout
+    if config.get("output_dir"):
+        output.set_output_dir(config["output_dir"], config.get("output_compression"))
+
+    # count requests in this ledger across runs, stopping cleanly once the per day or per run budget is spent
+    if config.get("api_budget_ledger"):
+        budget.set_budget(
+            config["api_budget_ledger"],
+            config.get("api_budget_per_day"),
+            config.get("api_budget_per_run"),
+            config.get("api_budget_low_fraction"),
+        )
+
+    # sync rows notified by Simpro webhooks from this queue, polling everything every webhook_poll_hours
+    if config.get("webhook_queue"):
+        change_queue = ChangeQueue(config["webhook_queue"])
+        webhook_poll_hours = float(config.get("webhook_poll_hours", webhook_poll_hours))
+
+    # "record" saves every response to cassette_path; "replay" serves them back without touching the API
+    if config.get("cassette_mode"):
+        set_cassette(Cassette(config["cassette_path"], config["cassette_mode"]))
+        freeze_page_sizes()
+
+
+@contextlib.asynccontextmanager
+async def open_session(config):
     access_token = config["access_token"]
     headers = {"Authorization": f"Bearer {access_token}"}
 
     async with aiohttp.ClientSession(headers=headers) as session:
-        session = RateLimiter(session)
-        await do_sync(session, state, catalog)
+        yield RateLimiter(session)
+
+
+async def run_async(config, state, catalog):
+    if profile_path is not None:
+        # resolved now, as daemon cycles move the output directory on
+        path = profile_path or os.path.join(output.output_dir or ".", "profile.folded")
+        profiling.start(asyncio.get_running_loop())
+
+    try:
+        async with open_session(config) as session:
+            # stay running and sync every daemon_interval_minutes with the same session, rather than syncing once and exiting
+            if config.get("daemon"):
+                # the daemon can receive the notifications itself too
+                if change_queue and config.get("webhook_port"):
+                    await start_receiver(
+                        change_queue,
+                        int(config["webhook_port"]),
+                        config.get("webhook_secret"),
+                    )
+
+                daemon = Daemon(
+                    lambda s: do_sync(session, s, catalog),
+                    state,
+                    float(config.get("daemon_interval_minutes", 15)),
+                    config.get("daemon_socket"),
+                )
+                await daemon.run()
+            else:
+                await do_sync(session, state, catalog)
+    finally:
+        output.shutdown()
+        save_page_sizes()
+        if utility.cassette:
+            utility.cassette.close()
+        if profile_path is not None:
+            profiling.stop()
+            profiling.write(path)
+
+
+# singer's argument parser would reject it, so --profile [path] is taken off the command line first
+def pop_profile_arg():
+    global profile_path
+    if "--profile" not in sys.argv:
+        return
+
+    i = sys.argv.index("--profile")
+    has_path = i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("-")
+    profile_path = sys.argv[i + 1] if has_path else ""
+    del sys.argv[i : i + 2 if has_path else i + 1]
 
 
 @singer.utils.handle_top_exception(logger)
 def main():
+    pop_profile_arg()
     args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
 
     if args.discover:
         do_discover()
     else:
         catalog = args.properties if args.properties else get_catalog()
-        set_base_url(args.config.get("base_url"))
+        configure(args.config)
         asyncio.get_event_loop().run_until_complete(
             run_async(args.config, args.state, catalog)
         )
@@ -0,0 +1,109 @@
+import os
+import json
+from datetime import datetime, timezone
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+# Counts every request made to the API in a ledger kept across runs, against optional per day and per run budgets
+# Off unless a ledger is set from __init__
+ledger_path = None
+per_day = None
+per_run = None
+# below this share of a budget left, optional work is dropped
+low_fraction = 0.2
+
+days = {}
+run_count = 0
+# streams that dropped optional work this run so mustn't move their bookmark past it
+degraded = set()
+# streams stopped by the budget, to go first next run
+unfinished = set()
+previously_unfinished = set()
+# stream -> where it stopped, so the next run picks up from there rather than starting over:
+#   archived: whether it was on the archived pass
+#   until: the DateModified of the last fully handled row, rows being read newest first, or None for the whole pass
+#   bookmarks: what the stopped run would have saved, to save once the rest is done
+resume = {}
+
+
+def set_budget(path, day_budget=None, run_budget=None, low=None):
+    global ledger_path, per_day, per_run, low_fraction
+    ledger_path = path
+    per_day = day_budget
+    per_run = run_budget
+    if low is not None:
+        low_fraction = low
+
+    if os.path.exists(path):
+        with open(path) as file:
+            ledger = json.load(file)
+        days.update(ledger.get("days", {}))
+        previously_unfinished.update(ledger.get("unfinished", []))
+        resume.update(ledger.get("resume", {}))
+
+
+def start_run():
+    global run_count
+    run_count = 0
+    degraded.clear()
+    unfinished.clear()
+
+
+def save_ledger():
+    global previously_unfinished
+    if not ledger_path:
+        return
+
+    # keep a month of history
+    recent = dict(sorted(days.items())[-31:])
+    with open(ledger_path, "w") as file:
+        json.dump(
+            {"days": recent, "unfinished": sorted(unfinished), "resume": resume},
+            file,
+            indent=2,
+        )
+    previously_unfinished = set(unfinished)
+
+
+# a stop before any row was handled keeps the earlier point, and later stops keep the first one's bookmarks as nothing before them was read since
+def set_resume(stream, archived, until, bookmarks):
+    previous = resume.get(stream)
+    if until is None and not archived:
+        return
+    resume[stream] = {
+        "archived": archived,
+        "until": until,
+        "bookmarks": previous["bookmarks"] if previous else bookmarks,
+    }
+
+
+def today():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def spend():
+    global run_count
+    if not ledger_path:
+        return
+
+    day = today()
+    if (per_day and days.get(day, 0) >= per_day) or (per_run and run_count >= per_run):
+        raise BudgetExhausted(
+            f"API budget spent: {days.get(day, 0)} requests today, {run_count} this run"
+        )
+
+    days[day] = days.get(day, 0) + 1
+    run_count += 1
+
+
+def is_low():
+    if not ledger_path:
+        return False
+
+    return bool(
+        (per_day and days.get(today(), 0) >= per_day * (1 - low_fraction))
+        or (per_run and run_count >= per_run * (1 - low_fraction))
+    )
@@ -0,0 +1,63 @@
+import json
+import hashlib
+import zipfile
+from aiohttp import ClientResponseError, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+# Records every response to a compressed zip archive, one member per URL, or replays them without the network
+# The zip's central directory doubles as the index so a replayed response is read without scanning the archive
+# Replays only match when the run requests the same URLs, so use the same catalog, config and state as the recording
+class Cassette:
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode}, expected record or replay")
+
+        self.replaying = mode == "replay"
+        # recording starts a new archive, or responses kept from an earlier recording would be replayed instead of this one's
+        self.archive = zipfile.ZipFile(
+            path, "r" if self.replaying else "w", compression=zipfile.ZIP_DEFLATED
+        )
+        self.index = set(self.archive.namelist())
+
+    @staticmethod
+    def key(url):
+        return hashlib.md5(url.encode("utf-8")).hexdigest() + ".json"
+
+    def record(self, url, status, body):
+        name = self.key(url)
+        # a URL can be requested more than once in a run; the first response is enough
+        if name in self.index:
+            return
+        self.archive.writestr(
+            name, json.dumps({"url": url, "status": status, "body": body})
+        )
+        self.index.add(name)
+
+    # `full_url` is only used in errors, which need the request they were for to be logged like a live one
+    def play(self, url, full_url):
+        name = self.key(url)
+        if name not in self.index:
+            raise CassetteMissError(f"No recorded response for {url}")
+
+        response = json.loads(self.archive.read(name))
+        # errors are recorded too as some are expected, e.g. 404s from service fees
+        if response["status"] >= 400:
+            request_url = URL(full_url)
+            raise ClientResponseError(
+                RequestInfo(
+                    request_url, "GET", CIMultiDictProxy(CIMultiDict()), request_url
+                ),
+                (),
+                status=response["status"],
+                message="Recorded error",
+            )
+        return response["body"]
+
+    def close(self):
+        self.archive.close()
@@ -1,3 +1,5 @@
+from tap_simpro.flatten import compile_flattener
+
 streams = {
     "contractors": ["contractor_timesheets"],
     "credit_notes": ["credit_note_jobs", "credit_note_cost_centers"],
@@ -93,13 +95,233 @@ streams_disable_filtering = set(
     ]
 )
 
+# list endpoints that accept Simpro's `?<field>=ge(<date>)` filter on their modified date, so incremental runs only get changed rows back
+# the client-side early exit in get_resource stays as the fallback for everything else
+# streams_disable_filtering always wins as their sub-streams need every parent row; timesheets are already narrowed with StartDate
+streams_server_side_filters = {
+    "activity_schedules": "DateModified",
+    "catalogs": "DateModified",
+    "contacts": "DateModified",
+    "credit_notes": "DateModified",
+    "customers": "DateModified",
+    "employees": "DateModified",
+    "invoices": "DateModified",
+    "job_cost_center_catalog_item": "DateModified",
+    "job_cost_center_labor_item": "DateModified",
+    "job_cost_center_one_off_item": "DateModified",
+    "job_cost_center_prebuild_item": "DateModified",
+    "job_cost_center_service_fee": "DateModified",
+    "job_work_orders": "DateModified",
+    "quotes": "DateModified",
+    "schedules": "DateModified",
+    "sites": "DateModified",
+    "tasks": "DateModified",
+    "vendor_order_credits": "DateModified",
+    "vendors": "DateModified",
+}
+
+# Simpro webhook event prefixes, e.g. "job" from "job.updated" -> (stream, key of the changed row's ID in the notification's reference)
+webhook_streams = {
+    "contractor": ("contractors", "contractorID"),
+    "customer": ("customers", "customerID"),
+    "employee": ("employees", "employeeID"),
+    "invoice": ("invoices", "invoiceID"),
+    "job": ("jobs", "jobID"),
+    "quote": ("quotes", "quoteID"),
+    "schedule": ("schedules", "scheduleID"),
+    "site": ("sites", "siteID"),
+    "vendorOrder": ("vendor_orders", "vendorOrderID"),
+}
+
 json_encoded_columns = {
     "jobs": ["RequestNo", "Name", "Description", "Notes"],
     "quotes": ["RequestNo", "Name", "Description", "Notes"],
     "tasks": ["Description", "Notes"],
 }
 
-resource_details_url_fns = {
-    "jobs": lambda row: f'jobs/{row["ID"]}?display=all',
-    "quotes": lambda row: f'quotes/{row["ID"]}?display=all',
+# details are only fetched with ?display=all, which adds every section's cost centers, when one of these sub-streams is selected
+# otherwise the plain details have all the parent's own fields for a much smaller payload
+resource_details_display_all = {
+    "jobs": ["job_sections"],
+    "quotes": ["quote_sections"],
+}
+
+# array sub-streams flattened out of their parent rows by tap_simpro.flatten
+flatten_specs = {
+    "credit_note_jobs": {
+        "path": ["Jobs"],
+        "parent_keys": [{"CreditNoteID": "ID"}],
+        # rename row ID to JobID so it's clearer
+        "rename": {"JobID": "ID"},
+        "id": "{CreditNoteID}_{JobID}",
+    },
+    "credit_note_cost_centers": {
+        "path": ["CostCenters"],
+        "parent_keys": [{"CreditNoteID": "ID"}],
+        "rename": {"JobCostCenterID": "ID"},
+        "id": "{CreditNoteID}_{JobCostCenterID}",
+    },
+    "invoice_jobs": {
+        "path": ["Jobs"],
+        "parent_keys": [{"InvoiceID": "ID"}],
+        "rename": {"JobID": "ID"},
+        "id": "{InvoiceID}_{JobID}",
+    },
+    "invoice_cost_centers": {
+        "path": ["CostCenters"],
+        "parent_keys": [{"InvoiceID": "ID"}],
+        "rename": {"JobCostCenterID": "ID"},
+        "id": "{InvoiceID}_{JobCostCenterID}",
+    },
+    # flattened from a job
+    "job_sections": {
+        "path": ["Sections"],
+        "parent_keys": [{"JobID": "ID"}],
+    },
+    # flattened from a job section
+    "job_cost_centers": {
+        "path": ["CostCenters"],
+        "parent_keys": [{"JobID": "JobID", "SectionID": "ID"}],
+    },
+    "job_tags": {
+        "path": ["Tags"],
+        "parent_keys": [{"JobID": "ID"}],
+        "rename": {"TagID": "ID"},
+        "id": "{JobID}_{TagID}",
+    },
+    "job_work_order_blocks": {
+        "path": ["Blocks"],
+        "parent_keys": [{"JobWorkOrderID": "ID"}],
+        "id": "{JobWorkOrderID}_{index}",
+    },
+    "quote_sections": {
+        "path": ["Sections"],
+        "parent_keys": [{"QuoteID": "ID"}],
+    },
+    "quote_cost_centers": {
+        "path": ["Sections", "CostCenters"],
+        "parent_keys": [{"QuoteID": "ID"}, {"SectionID": "ID"}],
+    },
+    "schedules_blocks": {
+        "path": ["Blocks"],
+        "parent_keys": [{"ScheduleID": "ID"}],
+        "id": "{ScheduleID}_{index}",
+    },
+    "task_assignees": {
+        "path": ["Assignees"],
+        "parent_keys": [{"TaskID": "ID"}],
+        "rename": {"AssigneeID": "ID"},
+        "id": "{TaskID}_{AssigneeID}",
+    },
+    # index resets with each new catalog item; only want to increment through the array
+    "vendor_order_receipt_items": {
+        "path": ["Catalogs", "Allocations"],
+        "parent_keys": [
+            {"VendorOrderReceiptID": "ID", "VendorOrderID": "VendorOrderNo"},
+            {"CatalogID": "Catalog.ID"},
+        ],
+        "id": "{VendorOrderReceiptID}_{CatalogID}_{index}",
+    },
+}
+
+
+def _vendor_order_item_allocations(v, r):
+    for a in r["Allocations"]:
+        a["VendorOrderID"] = v["ID"]
+        a["CostCenterID"] = v.get("AssignedTo", {}).get("ID")
+        a["Catalog"] = r["Catalog"]
+        a["Price"] = r["Price"]
+        a["ID"] = f'{v["ID"]}_{r["Catalog"]["ID"]}'
+    return r["Allocations"]
+
+
+def _job_cost_center_item_node(resource, suffix):
+    return {
+        "resource": resource,
+        "endpoint": lambda c: f'jobs/{c["JobID"]}/sections/{c["SectionID"]}/costCenters/{c["ID"]}/{suffix}',
+        "bookmark": True,
+        "annotate": lambda c, row: row.update(
+            job_id=c["JobID"], section_id=c["SectionID"], cost_center_id=c["ID"]
+        ),
+        # service fees can throw a 404 instead of just returning [], so handle that case
+        "ignore_404": True,
+    }
+
+
+# nested resources crawled level by level by tap_simpro.crawler, keyed by the handler's stream
+crawl_trees = {
+    "job_sections": [
+        {
+            "resource": "job_sections",
+            "rows": compile_flattener(flatten_specs["job_sections"]),
+            "children": [
+                {
+                    "resource": "job_cost_centers",
+                    "rows": compile_flattener(flatten_specs["job_cost_centers"]),
+                    "children": [
+                        _job_cost_center_item_node(
+                            "job_cost_center_catalog_item", "catalogs"
+                        ),
+                        _job_cost_center_item_node(
+                            "job_cost_center_labor_item", "labor"
+                        ),
+                        _job_cost_center_item_node(
+                            "job_cost_center_one_off_item", "oneOffs"
+                        ),
+                        _job_cost_center_item_node(
+                            "job_cost_center_prebuild_item", "prebuilds"
+                        ),
+                        _job_cost_center_item_node(
+                            "job_cost_center_service_fee", "serviceFees"
+                        ),
+                    ],
+                }
+            ],
+        }
+    ],
+    "vendor_order_item_allocations": [
+        {
+            "resource": "vendor_order_item_allocations",
+            "endpoint": lambda v: f'vendorOrders/{v["ID"]}/catalogs',
+            "details_url": lambda endpoint, row: f'{endpoint}/{row["Catalog"]["ID"]}',
+            "explode": _vendor_order_item_allocations,
+        }
+    ],
+    "vendor_order_receipts": [
+        {
+            "resource": "vendor_order_receipts",
+            "endpoint": lambda v: f'vendorOrders/{v["ID"]}/receipts',
+            "bookmark": True,
+            # helpful for credits
+            "annotate": lambda v, r: r.update(VendorOrderID=r["VendorOrderNo"]),
+            "children": [
+                {
+                    "resource": "vendor_order_receipt_items",
+                    "rows": compile_flattener(
+                        flatten_specs["vendor_order_receipt_items"]
+                    ),
+                },
+                {
+                    "resource": "vendor_order_credits",
+                    "endpoint": lambda r: f'vendorOrders/{r["VendorOrderID"]}/receipts/{r["ID"]}/credits',
+                    "bookmark": True,
+                    "annotate": lambda r, c: c.update(
+                        VendorOrderID=r["VendorOrderID"], VendorOrderReceiptID=r["ID"]
+                    ),
+                    "children": [
+                        {
+                            "resource": "vendor_order_credit_items",
+                            "endpoint": lambda c: f'vendorOrders/{c["VendorOrderID"]}/receipts/{c["VendorOrderReceiptID"]}/credits/{c["ID"]}/catalogs',
+                            "annotate": lambda c, i: i.update(
+                                VendorOrderID=c["VendorOrderID"],
+                                VendorOrderReceiptID=c["VendorOrderReceiptID"],
+                                VendorOrderCreditID=c["ID"],
+                                ID=f'{c["ID"]}_{i["Catalog"]["ID"]}',
+                            ),
+                        }
+                    ],
+                },
+            ],
+        }
+    ],
 }
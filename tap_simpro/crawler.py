@@ -0,0 +1,89 @@
+import asyncio
+from aiohttp import ClientResponseError
+from singer.bookmarks import get_bookmark
+
+from tap_simpro.utility import (
+    get_resource,
+    write_many,
+    await_futures,
+)
+
+# how many nodes are fetching their rows at once, across every level of every tree being crawled
+# held only while fetching, not while a node's children are crawled, so nested levels can't starve each other
+# actual requests are still capped by the shared semaphore and rate limiter in utility
+crawl_concurrency = 10
+crawl_sem = asyncio.Semaphore(crawl_concurrency)
+
+
+# A tree is a list of nodes, each describing how to get child rows from a parent row:
+#   resource: stream the rows are written to; the node and its children are skipped if the stream isn't selected
+#   endpoint: function of the parent row returning the endpoint to page through
+#   rows: function of the parent row returning the child rows when they're already nested in the parent (no request)
+#   bookmark: whether to filter by the stream's bookmark, defaults to False
+#   details_url: function of (endpoint, row) returning the details URL for each listed row
+#   annotate: function of (parent, row) adding parent reference fields to the row in place
+#   explode: function of (parent, row) returning the records to write in place of the row
+#   ignore_404: treat a 404 as an empty list
+#   children: nodes to expand for each row of this node
+async def crawl(session, nodes, parents, schemas, state, mdata, extraction_time):
+    futures = [
+        expand(session, node, parent, schemas, state, mdata, extraction_time)
+        for node in nodes
+        if node["resource"] in schemas
+        for parent in parents
+    ]
+    await await_futures(futures)
+
+
+async def expand(session, node, parent, schemas, state, mdata, extraction_time):
+    resource = node["resource"]
+    schema = schemas[resource]
+
+    if "rows" in node:
+        rows = node["rows"](parent)
+    else:
+        async with crawl_sem:
+            rows = await fetch_rows(session, node, parent, schema, state)
+
+    annotate = node.get("annotate")
+    explode = node.get("explode")
+    records = []
+    for row in rows:
+        if annotate:
+            annotate(parent, row)
+        if explode:
+            records.extend(explode(parent, row))
+        else:
+            records.append(row)
+
+    write_many(records, resource, schema, mdata, extraction_time)
+
+    children = node.get("children", [])
+    if children and rows:
+        await crawl(session, children, rows, schemas, state, mdata, extraction_time)
+
+
+async def fetch_rows(session, node, parent, schema, state):
+    resource = node["resource"]
+    endpoint = node["endpoint"](parent)
+    bookmark = get_bookmark(state, resource, "since") if node.get("bookmark") else None
+    details_url = node.get("details_url")
+
+    try:
+        return [
+            row
+            async for row in get_resource(
+                session,
+                resource,
+                bookmark,
+                schema,
+                endpoint_override=endpoint,
+                get_details_url=(lambda row: details_url(endpoint, row))
+                if details_url
+                else None,
+            )
+        ]
+    except ClientResponseError as e:
+        if node.get("ignore_404") and e.status == 404:
+            return []
+        raise e
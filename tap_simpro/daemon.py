@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import asyncio
+import singer
+from datetime import datetime, timezone
+
+from tap_simpro import output
+from tap_simpro.paging import save_page_sizes
+
+logger = singer.get_logger()
+
+
+# Runs incremental syncs on a schedule in one long-lived process, so the session, rate limiter,
+# tuned page sizes, latency history and catalog stay warm between cycles
+# A cycle can also be triggered early, and the daemon queried or stopped, over a local unix socket:
+#   tap-simpro-daemon /path/to/socket sync|status|stop
+class Daemon:
+    def __init__(self, sync, state, interval_minutes=15, socket_path=None):
+        # `sync` runs one cycle from a state and returns the new state
+        self.sync = sync
+        self.state = state
+        self.interval = interval_minutes * 60
+        self.socket_path = socket_path
+        self.output_dir = output.output_dir
+
+        self.trigger = asyncio.Event()
+        self.stopping = False
+        self.cycles = 0
+        self.last_cycle = None
+
+    async def run(self):
+        server = None
+        if self.socket_path:
+            server = await asyncio.start_unix_server(
+                self.handle_client, path=self.socket_path
+            )
+
+        try:
+            while not self.stopping:
+                await self.run_cycle()
+                try:
+                    await asyncio.wait_for(self.trigger.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.trigger.clear()
+        finally:
+            if server:
+                server.close()
+                await server.wait_closed()
+                os.remove(self.socket_path)
+
+    async def run_cycle(self):
+        self.cycles += 1
+        started = datetime.now(timezone.utc)
+        # each cycle gets its own set of files and manifest
+        if self.output_dir:
+            output.set_output_dir(
+                os.path.join(
+                    self.output_dir,
+                    f'{started.strftime("%Y%m%dT%H%M%SZ")}-{self.cycles}',
+                )
+            )
+
+        error = None
+        try:
+            new_state = await self.sync(self.state)
+        except Exception as e:
+            logger.exception(f"Sync cycle {self.cycles} failed: {e}")
+            # if only some streams failed, the state they wrote still moves the rest on
+            new_state = getattr(e, "state", None)
+            error = repr(e)
+
+        if new_state is not None:
+            # written state is flat but the next cycle reads it the singer way
+            self.state = {"bookmarks": {k: {"since": v} for k, v in new_state.items()}}
+        save_page_sizes()
+
+        self.last_cycle = {
+            "cycle": self.cycles,
+            "started": started.isoformat(),
+            "finished": datetime.now(timezone.utc).isoformat(),
+            "error": error,
+        }
+
+    async def handle_client(self, reader, writer):
+        command = (await reader.readline()).decode().strip()
+
+        if command == "sync":
+            self.trigger.set()
+            response = {"ok": True}
+        elif command == "status":
+            response = {"ok": True, "cycles": self.cycles, "last_cycle": self.last_cycle}
+        elif command == "stop":
+            self.stopping = True
+            self.trigger.set()
+            response = {"ok": True}
+        else:
+            response = {"ok": False, "error": f"Unknown command {command}"}
+
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+        writer.close()
+
+
+async def send_command(socket_path, command):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write((command + "\n").encode())
+    await writer.drain()
+    response = await reader.readline()
+    writer.close()
+    return json.loads(response)
+
+
+def main():
+    response = asyncio.get_event_loop().run_until_complete(
+        send_command(sys.argv[1], sys.argv[2])
+    )
+    print(json.dumps(response))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,65 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from singer.bookmarks import get_bookmark
+from aiohttp import ClientResponseError
 from tap_simpro.utility import (
     get_resource,
+    get_basic,
+    get_endpoint,
     transform_record,
+    format_date,
+    await_futures_bounded,
+    strip_href_url,
+)
+from tap_simpro.config import (
+    streams,
+    json_encoded_columns,
+    resource_details_display_all,
 )
-from tap_simpro.config import streams, json_encoded_columns, resource_details_url_fns
 from tap_simpro.handlers import handlers
 from tap_simpro.transforms import transforms
-from tap_simpro.utility import write_record
+from tap_simpro.output import write_records, drain, watermarks
+from tap_simpro import budget
+from tap_simpro import profiling
+
+# parent rows are handled in batches of up to this many, the most a page can have
+row_batch_size = 250
+# how many rows of a batch have their sub-stream handlers running at once
+# actual requests are still capped by the shared semaphore and rate limiter in utility
+row_concurrency = 10
+
+# bookmarks are moved back by this much from the latest DateModified written, to cover rows saved out of order in Simpro
+# note this is going to be updated from __init__
+bookmark_lookback = timedelta(minutes=5)
+watermark_format = "%Y-%m-%dT%H:%M:%S"
+
+
+def set_bookmark_lookback(minutes):
+    global bookmark_lookback
+    bookmark_lookback = timedelta(minutes=minutes)
+
+
+# run on each top-level row before it's written, on the event loop so sub-stream handlers always get the same row
+def prepare_record(row, resource, schema):
+    row = transform_record(
+        row, schema["properties"], json_encoded_columns.get(resource, [])
+    )
+
+    # only for top-level resources as sub-streams already have handler functions
+    if resource in transforms:
+        transforms[resource](row)
+
+    return row
+
+
+# only ask for the nested data on details if a selected sub-stream uses it
+def get_details_url_fn(resource, schemas):
+    nested_streams = resource_details_display_all.get(resource)
+    if nested_streams is None:
+        return None
+
+    endpoint = get_endpoint(resource)
+    display = "?display=all" if any(s in schemas for s in nested_streams) else ""
+    return lambda row: f'{endpoint}/{row["ID"]}{display}'
 
 
 async def handle_resource(session, resource, schemas, state, mdata):
@@ -22,24 +74,182 @@ async def handle_resource(session, resource, schemas, state, mdata):
         if substream in schemas and substream in handlers
     ]
 
-    new_bookmark = {resource: extraction_time}
-    for substream in streams.get(resource, []):
-        new_bookmark[substream] = extraction_time
+    resume = budget.resume.get(resource)
+    position = {}
+    # the pass and DateModified of the last row whose batch was fully handled, for picking up from if the API budget runs out
+    reached = (False, None)
+
+    async def _handle(batch):
+        nonlocal reached
+        await handle_rows(
+            session,
+            batch,
+            resource,
+            schemas,
+            state,
+            mdata,
+            substream_handlers,
+            extraction_time,
+        )
+        reached = (position.get("archived", False), batch[-1].get("DateModified"))
+
+    try:
+        batch = []
+        async for r in get_resource(
+            session,
+            resource,
+            bookmark,
+            schema,
+            get_details_url_fn(resource, schemas),
+            resume=resume,
+            position=position,
+        ):
+            batch.append(r)
+            if len(batch) >= row_batch_size:
+                await _handle(batch)
+                batch = []
 
-    async for r in get_resource(
-        session, resource, bookmark, schema, resource_details_url_fns.get(resource)
-    ):
-        row = transform_record(
-            r, schema["properties"], json_encoded_columns.get(resource, [])
+        if batch:
+            await _handle(batch)
+    except budget.BudgetExhausted:
+        budget.set_resume(
+            resource,
+            *reached,
+            get_new_bookmarks(resource, schemas, state, extraction_time),
         )
+        raise
+
+    # the archived pass is all that's left, so the next run only does that
+    if position.get("skipped_archived"):
+        budget.set_resume(
+            resource,
+            True,
+            None,
+            get_new_bookmarks(resource, schemas, state, extraction_time),
+        )
+        raise budget.BudgetExhausted("API budget too low for the archived pass")
+
+    if resume:
+        del budget.resume[resource]
+    return get_new_bookmarks(
+        resource, schemas, state, extraction_time, resume and resume["bookmarks"]
+    )
 
-        # only for top-level resources as sub-streams already have handler functions
-        if resource in transforms:
-            transforms[resource](row)
 
-        write_record(row, resource, schema, mdata, extraction_time)
+def get_new_bookmarks(resource, schemas, state, extraction_time, resumed=None):
+    new_bookmarks = {}
+    for stream in [resource, *streams.get(resource, [])]:
+        # optional work was dropped to save API budget, so the next run has to go over the same rows again
+        if resource in budget.degraded or stream in budget.degraded:
+            old_bookmark = get_bookmark(state, stream, "since")
+            if old_bookmark:
+                new_bookmarks[stream] = old_bookmark
+        # this run only did the rows a stopped run didn't get to, so it's that run's bookmarks that now hold
+        elif resumed is not None:
+            bookmark = resumed.get(stream) or get_bookmark(state, stream, "since")
+            if bookmark:
+                new_bookmarks[stream] = bookmark
+        else:
+            new_bookmarks[stream] = get_new_bookmark(
+                stream, schemas, state, extraction_time
+            )
+    return new_bookmarks
 
+
+# writes a batch of parent rows, then runs their sub-stream handlers for several rows at once
+# so one row's chain of nested requests doesn't hold up the next row's
+async def handle_rows(
+    session, rows, resource, schemas, state, mdata, substream_handlers, extraction_time
+):
+    schema = schemas[resource]
+    rows = [prepare_record(r, resource, schema) for r in rows]
+    # the whole batch goes to the record pool as one job
+    write_records(rows, resource, schema, mdata, extraction_time)
+
+    async def _handle(r):
         for fn in substream_handlers:
-            await fn(session, row, schemas, state, mdata)
+            with profiling.labelled(fn.__name__):
+                await fn(session, r, schemas, state, mdata)
+
+    if substream_handlers:
+        await await_futures_bounded([_handle(r) for r in rows], row_concurrency)
+
+    # keep the record pool's backlog bounded, raising only this stream's own write errors
+    await drain([resource, *streams.get(resource, [])])
+
+
+# Fetches and handles only the rows with the given IDs, e.g. from webhook notifications, rather than paging through the stream
+async def handle_ids(session, resource, ids, schemas, state, mdata):
+    extraction_time = datetime.now(timezone.utc).astimezone()
+    endpoint = get_endpoint(resource)
+    get_details_url = get_details_url_fn(resource, schemas)
+
+    substream_handlers = [
+        handlers[substream]
+        for substream in streams.get(resource, [])
+        if substream in schemas and substream in handlers
+    ]
+
+    async def _get(id):
+        try:
+            if get_details_url:
+                url = get_details_url({"ID": id})
+            else:
+                # the details URL isn't always the endpoint plus ID, e.g. customers/companies/{ID}, so look up the row's _href
+                listed = await get_basic(
+                    session, resource, f"{endpoint}/?ID={id}&columns=ID,_href"
+                )
+                if not listed:
+                    return None
+                url = (
+                    listed[0]["_href"].replace(strip_href_url, "")
+                    if "_href" in listed[0]
+                    else f"{endpoint}/{id}"
+                )
+            return await get_basic(session, resource, url)
+        # the row may have been deleted since the notification
+        except ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise e
+
+    rows = await await_futures_bounded([_get(id) for id in ids], 10)
+    rows = [r for r in rows if r is not None]
+    if rows:
+        await handle_rows(
+            session,
+            rows,
+            resource,
+            schemas,
+            state,
+            mdata,
+            substream_handlers,
+            extraction_time,
+        )
+
+
+# Bookmark from the latest DateModified actually written, so the next run re-reads as little as possible
+# Capped at the run's start time as rows changed mid-run could otherwise be skipped if the stream was read before them
+# Streams without DateModified still use the run's start time
+def get_new_bookmark(stream, schemas, state, extraction_time):
+    observed = watermarks.get(stream)
+    if observed:
+        try:
+            modified = datetime.fromisoformat(observed.replace("Z", "+00:00"))
+        except ValueError:
+            return format_date(extraction_time)
+
+        if modified.tzinfo:
+            cap = extraction_time.astimezone(modified.tzinfo)
+        else:
+            cap = extraction_time.replace(tzinfo=None)
+        watermark = min(modified, cap) - bookmark_lookback
+        return watermark.strftime(watermark_format)
+
+    schema = schemas.get(stream)
+    old_bookmark = get_bookmark(state, stream, "since")
+    # nothing new was written so there's nothing to move the bookmark past
+    if old_bookmark and (not schema or "DateModified" in schema["properties"]):
+        return old_bookmark
 
-    return new_bookmark
+    return format_date(extraction_time)
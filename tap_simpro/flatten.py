@@ -0,0 +1,71 @@
+from operator import itemgetter
+
+
+# A flattening spec describes how to pull child rows out of arrays nested in a parent row:
+#   path: keys of the nested arrays, outermost first, e.g. ["Catalogs", "Allocations"]
+#   parent_keys: one dict per level of `path` mapping child fields to (dotted) fields of that level's row
+#   rename: child fields to copy from the child's original fields, e.g. {"JobID": "ID"}
+#   id: template for the child's ID over the flattened fields, with {index} counting from 1 within the innermost array
+# Specs are compiled once into functions returning the flattened children of a parent row
+def compile_flattener(spec):
+    path = spec["path"]
+    last = len(path) - 1
+    parent_keys = spec.get("parent_keys", [])
+    levels = [
+        [
+            (field, _compile_getter(source))
+            for field, source in (parent_keys[i] if i < len(parent_keys) else {}).items()
+        ]
+        for i in range(len(path))
+    ]
+    renames = list(spec.get("rename", {}).items())
+    make_id = _compile_id(spec.get("id"))
+
+    def walk(row, level, inherited, records):
+        if levels[level]:
+            inherited = {**inherited, **{field: get(row) for field, get in levels[level]}}
+        children = row.get(path[level]) or []
+
+        if level < last:
+            for child in children:
+                walk(child, level + 1, inherited, records)
+            return
+
+        for i, child in enumerate(children, 1):
+            record = {**child, **inherited}
+            for field, source in renames:
+                record[field] = child[source]
+            if make_id:
+                record["ID"] = make_id(record, i)
+            records.append(record)
+
+    def flatten(parent):
+        records = []
+        walk(parent, 0, {}, records)
+        return records
+
+    return flatten
+
+
+def _compile_getter(source):
+    keys = source.split(".")
+    if len(keys) == 1:
+        return itemgetter(source)
+
+    getters = [itemgetter(k) for k in keys]
+
+    def get(row):
+        for g in getters:
+            row = g(row)
+        return row
+
+    return get
+
+
+def _compile_id(template):
+    if template is None:
+        return None
+    if "{index}" in template:
+        return lambda record, i: template.format(index=i, **record)
+    format_map = template.format_map
+    return lambda record, i: format_map(record)
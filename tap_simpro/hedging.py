@@ -0,0 +1,86 @@
+import time
+import asyncio
+from collections import defaultdict, deque
+
+
+# Detail calls slower than a percentile of recent ones, timed from when they're sent, get a duplicate request, and whichever returns first wins
+# Off unless turned on from __init__
+enabled = False
+percentile = 95
+# not enough to go on until there are this many recent calls for a resource
+min_samples = 20
+# each call adds this to the budget and each hedge spends 1, so hedges stay a small share of the rate limit
+budget_ratio = 0.05
+max_budget = 10
+budget = 0.0
+
+latencies = defaultdict(lambda: deque(maxlen=200))
+
+
+def set_hedging(hedge_percentile=None, hedge_budget=None):
+    global enabled, percentile, budget_ratio
+    enabled = True
+    if hedge_percentile:
+        percentile = hedge_percentile
+    if hedge_budget is not None:
+        budget_ratio = hedge_budget
+
+
+def get_threshold(resource):
+    samples = latencies[resource]
+    if len(samples) < min_samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+# `fetch(stats, hedge)` returns a new awaitable for the same idempotent GET each time it's called, see utility.get_basic
+# Only time from when a request is sent counts, as all of a page's details are queued for the semaphore and rate limiter at once
+async def hedged(resource, fetch):
+    global budget
+    if not enabled:
+        return await fetch()
+
+    budget = min(max_budget, budget + budget_ratio)
+    stats = {"on_sent": asyncio.Event()}
+    tasks = [asyncio.ensure_future(fetch(stats=stats))]
+
+    try:
+        threshold = get_threshold(resource)
+        if threshold is not None:
+            # replayed responses are never sent
+            sent = asyncio.ensure_future(stats["on_sent"].wait())
+            await asyncio.wait([tasks[0], sent], return_when=asyncio.FIRST_COMPLETED)
+            sent.cancel()
+
+            if not tasks[0].done():
+                remaining = threshold - (time.monotonic() - stats["sent"])
+                done, _ = await asyncio.wait(tasks, timeout=max(0, remaining))
+                if not done and budget >= 1:
+                    budget -= 1
+                    tasks.append(asyncio.ensure_future(fetch(hedge=True)))
+
+        result = await first_success(tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    # the original's response time, even if the hedge won, so the percentile isn't pulled down by the hedges
+    if "seconds" in stats:
+        latencies[resource].append(stats["seconds"])
+    elif "sent" in stats:
+        latencies[resource].append(time.monotonic() - stats["sent"])
+    return result
+
+
+# first successful result, or the last error if every task failed
+async def first_success(tasks):
+    pending = set(tasks)
+    while True:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                return task.result()
+        if not pending:
+            return done.pop().result()
@@ -0,0 +1,324 @@
+import os
+import sys
+import gzip
+import json
+import stat
+import queue
+import asyncio
+import threading
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import singer
+from singer import metadata
+
+from tap_simpro import profiling
+
+logger = singer.get_logger()
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Record processing (transforming and serialising) runs inline by default
+# With a pool set, batches are sent to worker threads or processes so the event loop only does network I/O
+executor = None
+# maximum batches waiting on the pool per stream before the producer is made to wait
+max_pending = 64
+# futures for each stream in submission order, so each stream's output stays in order
+pending = {}
+# stream -> the error from its first failed batch; it's raised once, to that stream, and its later batches are dropped
+failed = {}
+
+# highest DateModified written to each stream this sync, used for its next bookmark
+watermarks = {}
+
+# With an output directory set, each stream is written to its own NDJSON file instead of stdout
+output_dir = None
+output_compression = "gzip"
+# stream -> StreamSink for the current sync, None when writing to stdout
+sinks = None
+# stream -> (schema, key_properties) for the manifest
+sink_schemas = {}
+
+
+def set_record_pool(kind, workers, queue_size=None):
+    global executor, max_pending
+    if kind == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    if queue_size:
+        max_pending = queue_size
+
+
+def shutdown():
+    global executor
+    if executor:
+        executor.shutdown()
+        executor = None
+
+
+def set_output_dir(path, compression=None):
+    global output_dir, output_compression
+    output_dir = path
+    if compression:
+        if compression not in ("gzip", "zstd", "none"):
+            raise ValueError(
+                f"Unknown output compression {compression}, expected gzip, zstd or none"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd output compression needs the zstandard package")
+        output_compression = compression
+
+
+# must stay a module-level function so it can be pickled for a process pool
+# plain records are written for per-stream files, Singer RECORD messages otherwise
+def serialise_records(rows, resource, schema, mdata, dt, plain=False):
+    mdata_map = metadata.to_map(mdata)
+    lines = []
+    with singer.Transformer() as transformer:
+        for row in rows:
+            rec = transformer.transform(row, schema, metadata=mdata_map)
+            if plain:
+                lines.append(json.dumps(rec, default=str))
+            else:
+                lines.append(
+                    singer.format_message(
+                        singer.RecordMessage(
+                            stream=resource, record=rec, time_extracted=dt
+                        )
+                    )
+                )
+    return lines
+
+
+# errors like singer's SchemaMismatch can't be unpickled, which breaks the whole process pool, so workers raise plain ones
+def serialise_records_in_process(*args):
+    try:
+        return serialise_records(*args)
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+def emit(resource, lines):
+    with profiling.phase("write"):
+        if sinks is not None:
+            get_sink(resource).write(lines)
+        elif lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+
+def write_schema(stream, schema, key_properties):
+    if sinks is None:
+        singer.write_schema(stream, schema, key_properties)
+    else:
+        sink_schemas[stream] = (schema, key_properties)
+        # creating the sink up front means every selected stream gets a file, even if empty
+        get_sink(stream)
+
+
+# called at the start of each sync
+def start():
+    global sinks
+    watermarks.clear()
+    failed.clear()
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        sinks = {}
+
+
+# called at the end of each sync, before its state is written
+# returns the streams whose output failed, which have to keep their previous bookmarks
+async def finish():
+    global sinks
+    for resource, futures in list(pending.items()):
+        while futures:
+            await settled(futures[0])
+            try:
+                emit_done(resource)
+            except Exception as e:
+                # failed sinks are reported when closed
+                if failed.get(resource) is e:
+                    logger.error(f"Writing {resource} records failed: {e}")
+
+    failed_streams = set(failed)
+    if sinks is None:
+        return failed_streams
+
+    # close every sink even if one failed
+    for stream, sink in sinks.items():
+        try:
+            sink.close()
+        except Exception as e:
+            logger.error(f"Writing {stream} records failed: {e}")
+            failed_streams.add(stream)
+
+    write_manifest()
+    sinks = None
+    return failed_streams
+
+
+def get_sink(stream):
+    if stream not in sinks:
+        sinks[stream] = StreamSink(output_dir, stream, output_compression)
+    return sinks[stream]
+
+
+def write_manifest():
+    streams = {}
+    for stream, sink in sinks.items():
+        schema, key_properties = sink_schemas.get(stream, (None, None))
+        streams[stream] = {
+            "file": sink.filename,
+            "compression": sink.compression,
+            "records": sink.records,
+            "key_properties": key_properties,
+            "schema": schema,
+        }
+
+    manifest = {
+        "written_at": datetime.now(timezone.utc).isoformat(),
+        "streams": streams,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+# Writes one stream's NDJSON on its own thread so compression and disk writes for each stream run in parallel
+# If <stream>.ndjson already exists as a named pipe it's written to uncompressed instead
+# A failed write (full disk, pipe reader gone) is kept and raised from the next write, wait or close
+class StreamSink:
+    # batches waiting to be written before drain() makes the producer wait
+    queue_size = 64
+
+    def __init__(self, directory, stream, compression):
+        pipe_path = os.path.join(directory, f"{stream}.ndjson")
+        if os.path.exists(pipe_path) and stat.S_ISFIFO(os.stat(pipe_path).st_mode):
+            compression = "none"
+
+        self.compression = compression
+        self.filename = f"{stream}.ndjson" + {"gzip": ".gz", "zstd": ".zst"}.get(
+            compression, ""
+        )
+        path = os.path.join(directory, self.filename)
+
+        if compression == "gzip":
+            self.file = gzip.open(path, "wb")
+        elif compression == "zstd":
+            self.file = zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        else:
+            self.file = open(path, "wb")
+
+        self.records = 0
+        self.error = None
+        # unbounded so the event loop never blocks on it; drain() waits on wait() instead
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, lines):
+        if self.error:
+            raise self.error
+        if lines:
+            self.records += len(lines)
+            self.queue.put_nowait(lines)
+
+    async def wait(self):
+        while self.queue.qsize() > self.queue_size and not self.error:
+            await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+
+    def run(self):
+        while True:
+            lines = self.queue.get()
+            if lines is None:
+                break
+            # after a failure keep taking batches off the queue, they're just dropped
+            if self.error:
+                continue
+            try:
+                self.file.write(("\n".join(lines) + "\n").encode("utf-8"))
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put_nowait(None)
+        self.thread.join()
+        try:
+            self.file.close()
+        except Exception as e:
+            self.error = self.error or e
+        if self.error:
+            raise self.error
+
+
+def write_records(rows, resource, schema, mdata, dt):
+    observe(resource, rows)
+
+    plain = sinks is not None
+    if executor is None:
+        with profiling.phase("transform"):
+            lines = serialise_records(rows, resource, schema, mdata, dt, plain)
+        emit(resource, lines)
+        return
+
+    serialise = (
+        serialise_records_in_process
+        if isinstance(executor, ProcessPoolExecutor)
+        else serialise_records
+    )
+    futures = pending.setdefault(resource, deque())
+    futures.append(executor.submit(serialise, rows, resource, schema, mdata, dt, plain))
+    emit_done(resource)
+
+
+# simple string comparison works here, thanks to the date formatting
+def observe(resource, rows):
+    latest = watermarks.get(resource)
+    for row in rows:
+        modified = row.get("DateModified")
+        if modified and (latest is None or modified > latest):
+            latest = modified
+    if latest:
+        watermarks[resource] = latest
+
+
+def emit_done(resource):
+    futures = pending[resource]
+    while futures and futures[0].done():
+        future = futures.popleft()
+        if resource in failed:
+            continue
+        try:
+            lines = future.result()
+        except Exception as e:
+            failed[resource] = e
+            raise
+        emit(resource, lines)
+
+
+# waits for a batch without raising, emit_done raises its error to the stream it belongs to
+async def settled(future):
+    try:
+        await asyncio.wrap_future(future)
+    except Exception:
+        pass
+
+
+# wait until each of `resources` (default all) has at most `limit` batches pending
+# raises the first error from their batches or sinks, so a stream only ever sees its own
+async def drain(resources=None, limit=None):
+    limit = max_pending if limit is None else limit
+    for resource in list(pending) if resources is None else resources:
+        futures = pending.get(resource)
+        while futures and len(futures) > limit:
+            await settled(futures[0])
+            emit_done(resource)
+
+        if sinks and resource in sinks:
+            await sinks[resource].wait()
@@ -0,0 +1,60 @@
+import os
+import json
+
+
+# Simpro allows up to 250 rows per page, which is the fewest requests so is used unless an endpoint's pages get too slow or big
+max_page_size = 250
+min_page_size = 10
+# pages slower or bigger than these are halved; full pages well under both are doubled
+target_seconds = 10
+target_bytes = 4 * 1024 * 1024
+
+# resource -> tuned page size, remembered across runs if a cache file is set
+page_sizes = {}
+cache_path = None
+# a cassette's responses are keyed by URL, page size included, so sizes are left alone while recording or replaying one
+frozen = False
+
+
+def load_page_sizes(path):
+    global cache_path
+    cache_path = path
+    if os.path.exists(path):
+        with open(path) as file:
+            page_sizes.update(json.load(file))
+
+
+def freeze_page_sizes():
+    global frozen
+    frozen = True
+
+
+def save_page_sizes():
+    if cache_path and not frozen:
+        with open(cache_path, "w") as file:
+            json.dump(page_sizes, file, indent=2, sort_keys=True)
+
+
+def get_page_size(resource):
+    return page_sizes.get(resource, max_page_size)
+
+
+def observe_page(resource, page_size, rows, seconds, size):
+    if frozen:
+        return
+
+    if seconds > target_seconds or size > target_bytes:
+        new_size = max(min_page_size, page_size // 2)
+    elif (
+        rows == page_size
+        and seconds < target_seconds / 4
+        and size < target_bytes / 4
+    ):
+        new_size = min(max_page_size, page_size * 2)
+    else:
+        return
+
+    if new_size == max_page_size:
+        page_sizes.pop(resource, None)
+    else:
+        page_sizes[resource] = new_size
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import weakref
+import singer
+from collections import defaultdict
+
+logger = singer.get_logger()
+
+
+# With --profile, every thread's stack is sampled and each phase of a request or record is timed,
+# attributed to the stream and handler of the asyncio task doing the work
+# cProfile only sees the event loop, so tasks carry labels instead: new tasks inherit their creator's, and sync_stream and handle_rows set them
+# Off unless started from __init__, when the hooks below are all no-ops
+enabled = False
+interval = 0.005
+# samples whose innermost frame is one of these are waiting rather than using CPU
+idle_frames = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+}
+
+loop = None
+main_thread_id = None
+sampler = None
+started = None
+started_cpu = None
+
+# task -> (stream, handler)
+task_labels = weakref.WeakKeyDictionary()
+# task -> its innermost open Span
+task_spans = weakref.WeakKeyDictionary()
+unlabelled = ("-", "-")
+
+# (stream, handler, phase) -> seconds, summed over tasks so can add up to more than the run took
+wall = defaultdict(float)
+# (stream, handler, phase) -> samples using CPU
+cpu = defaultdict(int)
+# folded stack "stream;handler;phase;frame;..." -> samples
+stacks = defaultdict(int)
+
+
+def start(event_loop):
+    global enabled, loop, main_thread_id, sampler, started, started_cpu
+    enabled = True
+    loop = event_loop
+    main_thread_id = threading.get_ident()
+    loop.set_task_factory(task_factory)
+
+    started = time.perf_counter()
+    started_cpu = time.process_time()
+    sampler = threading.Thread(target=sample, name="profiler", daemon=True)
+    sampler.start()
+
+
+def stop():
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+    sampler.join()
+    loop.set_task_factory(None)
+
+
+def task_factory(event_loop, coro, **kwargs):
+    task = asyncio.Task(coro, loop=event_loop, **kwargs)
+    parent = asyncio.current_task(event_loop)
+    if parent is not None and parent in task_labels:
+        task_labels[task] = task_labels[parent]
+    return task
+
+
+def current_task():
+    # record pool threads must not pick up whatever task the event loop is running
+    if not enabled or threading.get_ident() != main_thread_id:
+        return None
+    return asyncio.current_task(loop)
+
+
+# labels the current task, and the tasks it goes on to create, for the rest of its life
+def label(stream=None, handler=None):
+    task = current_task()
+    if task is None:
+        return
+    old_stream, old_handler = task_labels.get(task, unlabelled)
+    task_labels[task] = (stream or old_stream, handler or old_handler)
+
+
+# labels the current task until the block exits
+class Labelled:
+    __slots__ = ("handler", "task", "previous")
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        self.task = current_task()
+        if self.task is not None:
+            self.previous = task_labels.get(self.task, unlabelled)
+            task_labels[self.task] = (self.previous[0], self.handler)
+
+    def __exit__(self, *exc):
+        if self.task is not None:
+            task_labels[self.task] = self.previous
+
+
+# times a phase of the current task; a nested phase's time isn't counted in its parent's
+class Span:
+    __slots__ = ("name", "task", "parent", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.task = current_task()
+        if self.task is None:
+            return
+        now = time.perf_counter()
+        self.parent = task_spans.get(self.task)
+        if self.parent is not None:
+            add_wall(self.task, self.parent.name, now - self.parent.start)
+        self.start = now
+        task_spans[self.task] = self
+
+    def __exit__(self, *exc):
+        if self.task is None:
+            return
+        now = time.perf_counter()
+        add_wall(self.task, self.name, now - self.start)
+        if self.parent is not None:
+            self.parent.start = now
+            task_spans[self.task] = self.parent
+        else:
+            task_spans.pop(self.task, None)
+
+
+class Noop:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+noop = Noop()
+
+
+def labelled(handler):
+    return Labelled(handler) if enabled else noop
+
+
+# phases are limiter, network, parse, transform and write
+def phase(name):
+    return Span(name) if enabled else noop
+
+
+def add_wall(task, name, seconds):
+    stream, handler = task_labels.get(task, unlabelled)
+    wall[(stream, handler, name)] += seconds
+
+
+def add_limiter_wait(seconds):
+    task = current_task()
+    if task is not None:
+        add_wall(task, "limiter", seconds)
+
+
+def sample():
+    own_id = threading.get_ident()
+    frame_names = {}
+
+    def name(code):
+        key = (code.co_filename, code.co_name)
+        if key not in frame_names:
+            frame_names[key] = f"{code.co_name} ({os.path.basename(code.co_filename)})"
+        return frame_names[key]
+
+    while enabled:
+        time.sleep(interval)
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+
+            code = frame.f_code
+            idle = (os.path.basename(code.co_filename), code.co_name) in idle_frames
+            if thread_id == main_thread_id:
+                task = asyncio.current_task(loop)
+                stream, handler = (
+                    task_labels.get(task, unlabelled) if task else unlabelled
+                )
+                span = task_spans.get(task) if task else None
+                if span is not None:
+                    current_phase = span.name
+                elif task is None:
+                    current_phase = "idle" if idle else "event loop"
+                else:
+                    current_phase = "other"
+            elif idle:
+                continue
+            else:
+                stream, handler, current_phase = (
+                    f"thread {thread_names.get(thread_id, thread_id)}",
+                    "-",
+                    "-",
+                )
+
+            if current_phase != "idle":
+                cpu[(stream, handler, current_phase)] += 1
+
+            frames = []
+            while frame is not None:
+                frames.append(name(frame.f_code))
+                frame = frame.f_back
+            stacks[";".join([stream, handler, current_phase, *reversed(frames)])] += 1
+
+
+# writes the folded stacks to `path`, for flamegraph.pl, speedscope and the like, and a summary next to it
+def write(path):
+    with open(path, "w") as file:
+        for stack, count in sorted(stacks.items()):
+            file.write(f"{stack} {count}\n")
+
+    def rows(totals, scale=1):
+        return [
+            {
+                "stream": stream,
+                "handler": handler,
+                "phase": phase_name,
+                "seconds": round(value * scale, 4),
+            }
+            for (stream, handler, phase_name), value in sorted(
+                totals.items(), key=lambda x: -x[1]
+            )
+        ]
+
+    summary_path = os.path.splitext(path)[0] + ".json"
+    summary = {
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+        "process_cpu_seconds": round(time.process_time() - started_cpu, 3),
+        "sample_interval": interval,
+        "samples": sum(stacks.values()),
+        "cpu": rows(cpu, interval),
+        "wall": rows(wall),
+    }
+    with open(summary_path, "w") as file:
+        json.dump(summary, file, indent=2)
+
+    logger.info(f"Profile written to {path} and {summary_path}")
+    for row in summary["cpu"][:10]:
+        logger.info(
+            f'CPU {row["seconds"]:.2f}s {row["stream"]} {row["handler"]} {row["phase"]}'
+        )
@@ -3,10 +3,15 @@ import json
 import time
 import hashlib
 import asyncio
-import singer
-from singer import metadata
+import functools
+import contextlib
 from datetime import datetime
 
+from tap_simpro.output import write_records
+from tap_simpro.paging import get_page_size, observe_page
+from tap_simpro.hedging import hedged
+from tap_simpro import budget
+from tap_simpro import profiling
 from tap_simpro.config import (
     streams,
     streams_with_details,
@@ -14,6 +19,7 @@ from tap_simpro.config import (
     streams_add_specified_columns,
     streams_exclude_specified_columns,
     streams_disable_filtering,
+    streams_server_side_filters,
 )
 
 
@@ -21,6 +27,8 @@ from tap_simpro.config import (
 # note this is going to be updated from __init__
 base_url = None
 strip_href_url = "/api/v1.0/companies/0/"
+# set from __init__ to record responses to, or replay them from, a tap_simpro.cassette.Cassette
+cassette = None
 
 sub_streams = set([x for v in streams.values() for x in v])
 
@@ -34,6 +42,11 @@ def set_base_url(base):
     base_url = base + "/api/v1.0/companies/0"
 
 
+def set_cassette(c):
+    global cassette
+    cassette = c
+
+
 def get_endpoint(resource):
     return {
         "accounts": "setup/accounts/chartOfAccounts",
@@ -45,12 +58,25 @@ def get_endpoint(resource):
     }.get(resource, to_camel_case(resource))
 
 
+# `resume` is where a run stopped by the API budget got to, see budget.resume, and rows it already handled are skipped
+# `position` is kept up to date with which pass the rows being yielded come from, and whether the archived pass was skipped, if passed
 async def get_resource(
-    session, resource, bookmark, schema, get_details_url=None, endpoint_override=None
+    session,
+    resource,
+    bookmark,
+    schema,
+    get_details_url=None,
+    endpoint_override=None,
+    resume=None,
+    position=None,
 ):
-    page_size = 250
     schema_fields = schema["properties"].keys()
+    until = resume["until"] if resume else None
     disable_filtering = resource in streams_disable_filtering
+    # re-reading unchanged rows for their sub-streams is optional work, so is dropped when the API budget is low
+    if disable_filtering and bookmark and budget.is_low():
+        disable_filtering = False
+        budget.degraded.add(resource)
 
     specify_columns = resource in streams_specify_columns
     if not specify_columns:
@@ -61,7 +87,29 @@ async def get_resource(
         columns_query_string = f'&columns={",".join(columns_excluding_specified) + streams_add_specified_columns.get(resource, "")}'
     # print(columns_query_string)
 
+    # if columns are specified then don't need to fetch details
+    has_details = streams_with_details.get(resource, True) and not specify_columns
+
+    # when filtering by bookmark, get DateModified in the list too so rows that haven't changed are dropped before spending a detail call on them
+    # likewise rows a stopped run already handled
+    stale_filter = bookmark and not disable_filtering
+    prefilter = (
+        has_details and (stale_filter or until) and "DateModified" in schema_fields
+    )
+    if prefilter:
+        # _href too, as it's the details URL for streams like customers where that isn't just the endpoint plus ID
+        columns_query_string = "&columns=ID,DateModified,_href"
+
+    filter_query_string = ""
+    filter_field = streams_server_side_filters.get(resource)
+    if bookmark and not disable_filtering and filter_field:
+        # bookmarks can be saved with a space between date and time but the API wants ISO 8601
+        since = bookmark[:19].replace(" ", "T")
+        filter_query_string = f"&{filter_field}=ge({since})"
+
     async def _get(archived):
+        # tuned per endpoint, but can't change mid-way through paging
+        page_size = get_page_size(resource)
         page = 1
         while True:
             endpoint = (
@@ -69,11 +117,16 @@ async def get_resource(
             )
             # recurring invoices uses Removed instead of Archived
             # API ignores fields that aren't present, so can safely send both archived and removed each time
-            url = f"{endpoint}/?pageSize={page_size}&page={page}&Archived={archived}&Removed={archived}&orderby=-DateModified{columns_query_string}"
+            url = f"{endpoint}/?pageSize={page_size}&page={page}&Archived={archived}&Removed={archived}&orderby=-DateModified{filter_query_string}{columns_query_string}"
 
             # print("URL", url)
-            json = await get_basic(session, resource, url)
+            stats = {}
+            json = await get_basic(session, resource, url, stats)
             # print(json)
+            if stats:
+                observe_page(
+                    resource, page_size, len(json), stats["seconds"], stats["bytes"]
+                )
 
             if len(json) == 0:
                 return
@@ -89,15 +142,32 @@ async def get_resource(
                     else (row["_href"].replace(strip_href_url, ""))
                 )
 
-            # if columns are specified then don't need to fetch details
-            has_details = (
-                streams_with_details.get(resource, True) and not specify_columns
+            # rows are sorted by DateModified so anything newer than where a stopped run got to was handled by it
+            unhandled = (
+                [r for r in json if r.get("DateModified", until) <= until]
+                if until
+                else json
             )
+
             if has_details:
+                rows = unhandled
+                if prefilter and stale_filter:
+                    rows = [
+                        r
+                        for r in unhandled
+                        if r.get("DateModified", bookmark) >= bookmark
+                    ]
+
+                # the page only moves on once the slowest detail returns, so these can be hedged
                 details_ls = await await_futures(
                     [
-                        get_basic(session, resource, _get_details_url(row))
-                        for row in json
+                        hedged(
+                            resource,
+                            functools.partial(
+                                get_basic, session, resource, _get_details_url(row)
+                            ),
+                        )
+                        for row in rows
                     ]
                 )
 
@@ -112,6 +182,10 @@ async def get_resource(
                         return
 
                     yield d
+
+                # rows are sorted by DateModified so anything after a stale row is stale too
+                if len(rows) < len(unhandled):
+                    return
             else:
                 # if the list returns DateModified too, then use that to return early
                 last_modified = json[-1].get("DateModified")
@@ -122,13 +196,13 @@ async def get_resource(
                     and last_modified < bookmark
                 ):
                     # only add rows updated since the bookmark
-                    for r in json:
+                    for r in unhandled:
                         if r.get("DateModified") >= bookmark:
                             yield r
 
                     return
                 else:
-                    for r in json:
+                    for r in unhandled:
                         yield r
 
             # otherwise will always finish with a guaranteed-empty request that will return []
@@ -136,20 +210,66 @@ async def get_resource(
                 return
 
     # no query string option to get archived and unarchived (or removed and not removed), so run it once with each
-    async for row in _get(False):
-        yield row
+    # a run stopped on the archived pass already got through the first
+    if not (resume and resume["archived"]):
+        if position is not None:
+            position["archived"] = False
+        async for row in _get(False):
+            yield row
+        until = None
 
     # only run a second time if records can be archived/removed, or it'll just ignore the query parameter and fetch all records a second time
     if "Archived" in schema_fields or "Removed" in schema_fields:
+        # the archived pass is optional work too
+        # callers tracking the position pick the pass up next run instead
+        if budget.is_low():
+            if position is not None:
+                position["skipped_archived"] = True
+            else:
+                budget.degraded.add(resource)
+            return
+
+        if position is not None:
+            position["archived"] = True
         async for row in _get(True):
             yield row
 
 
-async def get_basic(session, resource, url):
-    async with sem:
-        async with await session.get(f"{base_url}/{url}") as resp:
-            resp.raise_for_status()
-            return await resp.json()
+# `stats` is filled with the response's size and time taken from sending the request, if passed
+# along with when it was sent, setting stats["on_sent"] too if that's an asyncio.Event
+# a `hedge` doesn't queue for the semaphore behind the requests it's racing, but still needs a rate limiter token
+async def get_basic(session, resource, url, stats=None, hedge=False):
+    if cassette and cassette.replaying:
+        return cassette.play(url, f"{base_url}/{url}")
+
+    budget.spend()
+    waited = time.monotonic()
+    async with contextlib.nullcontext() if hedge else sem:
+        profiling.add_limiter_wait(time.monotonic() - waited)
+        with profiling.phase("network"):
+            # waits for a rate limiter token
+            request = await session.get(f"{base_url}/{url}")
+            # so `stats` only times the endpoint itself, not the queue for a token
+            start = time.monotonic()
+            if stats is not None:
+                stats["sent"] = start
+                if "on_sent" in stats:
+                    stats["on_sent"].set()
+            async with request as resp:
+                if cassette and resp.status >= 400:
+                    cassette.record(url, resp.status, None)
+                resp.raise_for_status()
+                body = await resp.read()
+                with profiling.phase("parse"):
+                    json = await resp.json()
+
+        if stats is not None:
+            stats["seconds"] = time.monotonic() - start
+            stats["bytes"] = len(body)
+
+    if cassette:
+        cassette.record(url, resp.status, json)
+    return json
 
 
 def transform_record(record, properties, json_encoded_columns):
@@ -165,8 +285,26 @@ def transform_record(record, properties, json_encoded_columns):
     return record
 
 
+# if one fails the rest are cancelled, so nothing carries on writing records after the caller has given up
 async def await_futures(futures):
-    return await asyncio.gather(*futures)
+    tasks = [asyncio.ensure_future(f) for f in futures]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+# same as await_futures but with at most `limit` of the futures running at once
+async def await_futures_bounded(futures, limit):
+    bound = asyncio.Semaphore(limit)
+
+    async def _run(future):
+        async with bound:
+            return await future
+
+    return await await_futures([_run(f) for f in futures])
 
 
 # Rate limit is 10 requests per second, per https://developer.simprogroup.com/apidoc/?page=ed8457e003ba0f6197756eca5a61fde9
@@ -174,20 +312,25 @@ async def await_futures(futures):
 class RateLimiter:
     # slightly lower to give a safe buffer
     rate = 8  # requests per second
+    # most tokens saved up, so no one second sees more than rate + burst requests, even straight after an idle gap (e.g. between daemon cycles)
+    burst = 1
 
     def __init__(self, client):
         self.client = client
-        self.tokens = self.rate
+        self.tokens = self.burst
         self.updated_at = time.monotonic()
 
     async def get(self, *args, **kwargs):
-        await self.wait_for_token()
+        with profiling.phase("limiter"):
+            await self.wait_for_token()
         return self.client.get(*args, **kwargs)
 
     async def wait_for_token(self):
+        self.add_new_tokens()
         while self.tokens < 1:
+            # until the next token is due, as with a small burst a fixed sleep would waste part of the rate
+            await asyncio.sleep((1 - self.tokens) / self.rate)
             self.add_new_tokens()
-            await asyncio.sleep(0.1)
         self.tokens -= 1
 
     # would be nice to just make this an async loop but you can't do that easily in Python, unlike Node
@@ -195,7 +338,7 @@ class RateLimiter:
         now = time.monotonic()
         time_since_update = now - self.updated_at
         new_tokens = time_since_update * self.rate
-        self.tokens += new_tokens
+        self.tokens = min(self.burst, self.tokens + new_tokens)
         self.updated_at = now
 
 
@@ -227,14 +370,12 @@ def get_abs_path(path):
 
 
 def write_record(row, resource, schema, mdata, dt):
-    with singer.Transformer() as transformer:
-        rec = transformer.transform(row, schema, metadata=metadata.to_map(mdata))
-    singer.write_record(resource, rec, time_extracted=dt)
+    write_records([row], resource, schema, mdata, dt)
 
 
+# one transformer and metadata map for the whole batch rather than per row
 def write_many(rows, resource, schema, mdata, dt):
-    for row in rows:
-        write_record(row, resource, schema, mdata, dt)
+    write_records(rows, resource, schema, mdata, dt)
 
 
 # per https://stackoverflow.com/questions/19053707/converting-snake-case-to-lower-camel-case-lowercamelcase#19053800
@@ -0,0 +1,165 @@
+import sys
+import hmac
+import sqlite3
+import argparse
+import asyncio
+import aiohttp
+from aiohttp import web
+from datetime import datetime, timezone
+
+from tap_simpro.config import webhook_streams
+
+
+# Durable queue of resource IDs that Simpro has notified us have changed
+# The receiver and the tap can be separate processes, so everything goes through sqlite
+class ChangeQueue:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS changes (stream TEXT, id TEXT, received_at TEXT, PRIMARY KEY (stream, id))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.db.commit()
+
+    def add(self, stream, id):
+        # a later notification for the same row just moves its received time on
+        self.db.execute(
+            "INSERT OR REPLACE INTO changes VALUES (?, ?, ?)",
+            (stream, str(id), datetime.now(timezone.utc).isoformat()),
+        )
+        self.db.commit()
+
+    # stream -> [(id, received_at)]
+    def pending(self):
+        changes = {}
+        for stream, id, received_at in self.db.execute(
+            "SELECT stream, id, received_at FROM changes ORDER BY received_at"
+        ):
+            changes.setdefault(stream, []).append((id, received_at))
+        return changes
+
+    # only removes rows that haven't been notified again since they were read
+    def remove(self, stream, changes):
+        self.db.executemany(
+            "DELETE FROM changes WHERE stream = ? AND id = ? AND received_at = ?",
+            [(stream, id, received_at) for id, received_at in changes],
+        )
+        self.db.commit()
+
+    def remove_before(self, stream, received_at):
+        self.db.execute(
+            "DELETE FROM changes WHERE stream = ? AND received_at < ?",
+            (stream, received_at),
+        )
+        self.db.commit()
+
+    def get_last_poll(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_poll'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_last_poll(self, dt):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('last_poll', ?)", (dt.isoformat(),)
+        )
+        self.db.commit()
+
+
+# Simpro notifications look like {"ID": "job.updated", "reference": {"companyID": 0, "jobID": 123}, ...}
+def parse_notification(payload):
+    prefix = str(payload.get("ID", "")).split(".")[0]
+    if prefix not in webhook_streams:
+        return None
+
+    stream, id_key = webhook_streams[prefix]
+    id = payload.get("reference", {}).get(id_key)
+    if id is None:
+        return None
+    return stream, id
+
+
+# the X-Webhook-Secret header is preferred, as query strings end up in access logs
+# ?secret= is still accepted for senders that can only be given a URL
+def is_authorised(request, secret):
+    given = request.headers.get("X-Webhook-Secret")
+    if given is None:
+        given = request.query.get("secret")
+    # constant time, so the secret can't be guessed a character at a time
+    return given is not None and hmac.compare_digest(
+        given.encode("utf-8"), secret.encode("utf-8")
+    )
+
+
+def make_app(queue, secret=None):
+    async def receive(request):
+        if secret and not is_authorised(request, secret):
+            return web.Response(status=403)
+
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        change = parse_notification(payload)
+        if change:
+            queue.add(*change)
+        # acknowledge anything we don't sync too, so Simpro doesn't keep retrying it
+        return web.Response(status=202)
+
+    app = web.Application()
+    app.router.add_post("/{tail:.*}", receive)
+    return app
+
+
+async def start_receiver(queue, port, secret=None, host="0.0.0.0"):
+    runner = web.AppRunner(make_app(queue, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# local stand-in for Simpro, for testing the receiver
+async def send_notification(url, event, id, secret=None):
+    prefix = event.split(".")[0]
+    id_key = webhook_streams[prefix][1] if prefix in webhook_streams else "ID"
+    payload = {
+        "ID": event,
+        "reference": {"companyID": 0, id_key: id},
+        "date_triggered": datetime.now(timezone.utc).isoformat(),
+    }
+    headers = {"X-Webhook-Secret": secret} if secret else {}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=payload, headers=headers) as resp:
+            return resp.status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simpro webhook receiver")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="receive notifications into a queue")
+    serve.add_argument("--queue", required=True, help="path of the sqlite queue")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--secret")
+
+    send = commands.add_parser("send", help="send a test notification")
+    send.add_argument("--url", default="http://localhost:8080/")
+    send.add_argument("--event", required=True, help="e.g. job.updated")
+    send.add_argument("--id", required=True)
+    send.add_argument("--secret")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        web.run_app(make_app(ChangeQueue(args.queue), args.secret), port=args.port)
+    else:
+        status = asyncio.get_event_loop().run_until_complete(
+            send_notification(args.url, args.event, args.id, args.secret)
+        )
+        print(status)
+        sys.exit(0 if status < 400 else 1)
+
+
+if __name__ == "__main__":
+    main()